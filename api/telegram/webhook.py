@@ -4,25 +4,249 @@
 Telegram бот с интеграцией через API Bridge
 """
 
+import hmac
 import json
 import os
 import logging
+import time
+import threading
 import requests
+from contextlib import contextmanager
 from datetime import datetime
 
-# Настройки
+# Логирование
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def get_env_number(name, default, cast, minimum):
+    """Числовая настройка из окружения; при ошибке используется значение по умолчанию"""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    
+    try:
+        value = cast(raw)
+    except ValueError:
+        logger.error(f"Некорректное значение {name}={raw!r}, используется {default}")
+        return default
+    
+    if value < minimum:
+        logger.error(f"Значение {name}={raw!r} меньше {minimum}, используется {minimum}")
+        return minimum
+    return value
+
+# Настройки бота по умолчанию (используются, если TELEGRAM_TENANTS не задан)
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-PYTHONANYWHERE_API = "https://auniverquizes.pythonanywhere.com/api"
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+PYTHONANYWHERE_API = os.environ.get('PYTHONANYWHERE_API', "https://auniverquizes.pythonanywhere.com/api")
 
-# Логирование
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Реестр ботов в формате JSON:
+# {"<секрет пути>": {"name": "...", "token": "...", "api_url": "...", "supabase_url": "...",
+#                    "supabase_key": "...", "site_url": "...", "header_secret": "..."}}
+TELEGRAM_TENANTS = os.environ.get('TELEGRAM_TENANTS')
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Окно подавления повторных нажатий на кнопки одного сообщения (секунды)
+CALLBACK_DEBOUNCE_SECONDS = 2.0
+
+# Лимиты одного бота: одновременные исходящие запросы и ожидание свободного слота (секунды)
+TENANT_MAX_CONCURRENCY = get_env_number('TENANT_MAX_CONCURRENCY', 4, int, 1)
+TENANT_ACQUIRE_TIMEOUT = get_env_number('TENANT_ACQUIRE_TIMEOUT', 1.0, float, 0.0)
+
+# Бюджет запросов одного бота к Telegram Bot API (запросов в секунду)
+TELEGRAM_RATE_LIMIT = get_env_number('TELEGRAM_RATE_LIMIT', 30.0, float, 1.0)
+
+# Время жизни кэша списка предметов (секунды)
+SUBJECTS_CACHE_SECONDS = 300
+
+# Состояние текущего обновления в потоке воркера
+_update_state = threading.local()
+
+class TenantBusyError(Exception):
+    """Исчерпаны слоты или бюджет исходящих запросов бота"""
+
+class Tenant:
+    """Конфигурация бота и его собственные пулы соединений, кэши и лимиты"""
+    
+    def __init__(self, name, token, api_url, supabase_url, supabase_key, site_url=None, header_secret=None):
+        self.name = name
+        self.token = token
+        self.api_url = api_url.rstrip('/')
+        if site_url is None:
+            site_url = self.api_url[:-len('/api')] if self.api_url.endswith('/api') else self.api_url
+        self.site_url = site_url.rstrip('/')
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.header_secret = header_secret
+        self.recent_callbacks = {}
+        self.recent_callbacks_lock = threading.Lock()
+        self.subjects_cache = None
+        
+        self._slots = threading.BoundedSemaphore(TENANT_MAX_CONCURRENCY)
+        self._lock = threading.Lock()
+        self._budget_lock = threading.Lock()
+        self._telegram_tokens = TELEGRAM_RATE_LIMIT
+        self._telegram_refilled_at = time.monotonic()
+        self._session = None
+        self._supabase = None
+    
+    @property
+    def session(self):
+        """HTTP-сессия бота, создается при первом обращении"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = requests.Session()
+        return self._session
+    
+    @property
+    def supabase(self):
+        """Клиент Supabase бота, создается при первом обращении"""
+        if self._supabase is None:
+            with self._lock:
+                if self._supabase is None:
+                    from supabase import create_client
+                    self._supabase = create_client(self.supabase_url, self.supabase_key)
+        return self._supabase
+    
+    @contextmanager
+    def slot(self):
+        """Занимает слот исходящего запроса, чтобы медленный бот не занял весь воркер"""
+        if not self._slots.acquire(timeout=TENANT_ACQUIRE_TIMEOUT):
+            raise TenantBusyError(f"Бот {self.name}: превышен лимит одновременных запросов")
+        try:
+            yield
+            # После выполненного запроса повторная доставка обновления повторит его эффекты
+            _update_state.outbound_done = True
+        finally:
+            self._slots.release()
+    
+    def take_telegram_budget(self):
+        """Списывает один запрос из бюджета бота к Telegram (token bucket)"""
+        deadline = time.monotonic() + TENANT_ACQUIRE_TIMEOUT
+        while True:
+            with self._budget_lock:
+                now = time.monotonic()
+                self._telegram_tokens = min(
+                    TELEGRAM_RATE_LIMIT,
+                    self._telegram_tokens + (now - self._telegram_refilled_at) * TELEGRAM_RATE_LIMIT
+                )
+                self._telegram_refilled_at = now
+                
+                if self._telegram_tokens >= 1:
+                    self._telegram_tokens -= 1
+                    return
+                
+                wait = (1 - self._telegram_tokens) / TELEGRAM_RATE_LIMIT
+            
+            if now + wait > deadline:
+                raise TenantBusyError(f"Бот {self.name}: исчерпан бюджет запросов к Telegram")
+            time.sleep(wait)
+    
+    def request(self, method, url, **kwargs):
+        """Исходящий HTTP-запрос через пул соединений бота"""
+        kwargs.setdefault('timeout', 10)
+        if url.startswith(TELEGRAM_API_URL):
+            self.take_telegram_budget()
+        with self.slot():
+            return self.session.request(method, url, **kwargs)
+    
+    def telegram_url(self, api_method):
+        """URL метода Telegram Bot API для этого бота"""
+        return f"{TELEGRAM_API_URL}/bot{self.token}/{api_method}"
+    
+    def verify_header_secret(self, header_secret):
+        """Проверка заголовка X-Telegram-Bot-Api-Secret-Token, если он настроен"""
+        if not self.header_secret:
+            return True
+        return hmac.compare_digest((header_secret or '').encode(), self.header_secret.encode())
+
+_tenants = None
+_tenants_lock = threading.Lock()
+
+def load_tenants():
+    """Загрузка и проверка реестра ботов из окружения"""
+    if not TELEGRAM_TENANTS:
+        # Один бот на голом пути /api/telegram/webhook
+        if not TELEGRAM_WEBHOOK_SECRET:
+            logger.warning("TELEGRAM_WEBHOOK_SECRET не задан: webhook принимает запросы без проверки заголовка")
+        return {
+            '': Tenant(
+                'default', TELEGRAM_BOT_TOKEN, PYTHONANYWHERE_API, SUPABASE_URL, SUPABASE_KEY,
+                header_secret=TELEGRAM_WEBHOOK_SECRET
+            )
+        }
+    
+    try:
+        registry = json.loads(TELEGRAM_TENANTS)
+    except ValueError as e:
+        logger.error(f"Ошибка конфигурации TELEGRAM_TENANTS: некорректный JSON ({e})")
+        return {}
+    
+    if not isinstance(registry, dict):
+        logger.error("Ошибка конфигурации TELEGRAM_TENANTS: ожидается объект {секрет: настройки}")
+        return {}
+    
+    tenants = {}
+    for index, (secret, config) in enumerate(registry.items()):
+        # Секрет пути в логи не попадает, бот указывается по номеру и имени
+        label = f"#{index}"
+        if isinstance(config, dict) and config.get('name'):
+            label += f" ({config['name']})"
+        
+        if not isinstance(config, dict):
+            logger.error(f"Ошибка конфигурации TELEGRAM_TENANTS: бот {label} должен быть объектом")
+            continue
+        
+        missing = [field for field in ('token', 'api_url') if not config.get(field)]
+        if missing:
+            logger.error(f"Ошибка конфигурации TELEGRAM_TENANTS: у бота {label} не заданы {', '.join(missing)}")
+            continue
+        
+        supabase_url = config.get('supabase_url')
+        supabase_key = config.get('supabase_key')
+        if not supabase_url or not supabase_key:
+            if not SUPABASE_URL or not SUPABASE_KEY:
+                logger.error(f"Ошибка конфигурации TELEGRAM_TENANTS: у бота {label} не задан проект Supabase")
+                continue
+            logger.warning(f"У бота {label} не задан проект Supabase, используются SUPABASE_URL/SUPABASE_KEY")
+            supabase_url, supabase_key = SUPABASE_URL, SUPABASE_KEY
+        
+        tenants[secret] = Tenant(
+            config.get('name') or f"bot{config['token'].split(':', 1)[0]}",
+            config['token'],
+            config['api_url'],
+            supabase_url,
+            supabase_key,
+            config.get('site_url'),
+            config.get('header_secret')
+        )
+    return tenants
+
+def get_tenant(secret):
+    """Поиск бота по секрету из пути webhook"""
+    global _tenants
+    if _tenants is None:
+        with _tenants_lock:
+            if _tenants is None:
+                _tenants = load_tenants()
+    
+    secret = (secret or '').encode()
+    for tenant_secret, tenant in _tenants.items():
+        if hmac.compare_digest(tenant_secret.encode(), secret):
+            return tenant
+    return None
+
+def get_webhook_secret(request):
+    """Секрет бота из пути webhook"""
+    return request.args.get('secret', '')
 
-def send_message(chat_id, text, reply_markup=None):
+def send_message(tenant, chat_id, text, reply_markup=None):
     """Отправка сообщения в Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = tenant.telegram_url('sendMessage')
     data = {
         'chat_id': chat_id,
         'text': text,
@@ -33,24 +257,94 @@ def send_message(chat_id, text, reply_markup=None):
         data['reply_markup'] = json.dumps(reply_markup)
     
     try:
-        response = requests.post(url, json=data, timeout=10)
+        response = tenant.request('POST', url, json=data)
         return response.json()
+    except TenantBusyError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения: {e}")
         return None
 
-def get_user_from_pythonanywhere(telegram_id):
+def edit_message(tenant, chat_id, message_id, text, reply_markup=None):
+    """Редактирование существующего сообщения в Telegram"""
+    url = tenant.telegram_url('editMessageText')
+    data = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    
+    if reply_markup:
+        data['reply_markup'] = json.dumps(reply_markup)
+    
+    try:
+        response = tenant.request('POST', url, json=data)
+        result = response.json()
+    except TenantBusyError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка редактирования сообщения: {e}")
+        return None
+    
+    if not result.get('ok'):
+        description = result.get('description', '')
+        if 'message is not modified' in description:
+            # Сообщение уже показывает тот же текст и клавиатуру
+            logger.info("Сообщение не изменилось, редактирование пропущено")
+        else:
+            logger.error(f"Ошибка редактирования сообщения: {description}")
+    return result
+
+def send_or_edit_message(tenant, chat_id, text, reply_markup=None, message_id=None):
+    """Редактирует сообщение, если известен message_id, иначе отправляет новое"""
+    if message_id:
+        return edit_message(tenant, chat_id, message_id, text, reply_markup)
+    return send_message(tenant, chat_id, text, reply_markup)
+
+def answer_callback_query(tenant, callback_query_id):
+    """Подтверждение нажатия на inline-кнопку, чтобы убрать индикатор загрузки"""
+    url = tenant.telegram_url('answerCallbackQuery')
+    
+    try:
+        response = tenant.request('POST', url, json={'callback_query_id': callback_query_id})
+        return response.json()
+    except TenantBusyError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка подтверждения callback: {e}")
+        return None
+
+def is_duplicate_callback(tenant, chat_id, message_id, data):
+    """Проверка повторного нажатия той же кнопки на том же сообщении"""
+    now = time.monotonic()
+    key = (chat_id, message_id)
+    
+    with tenant.recent_callbacks_lock:
+        # Удаляем устаревшие записи, чтобы словарь не рос бесконечно
+        for old_key, (_, pressed_at) in list(tenant.recent_callbacks.items()):
+            if now - pressed_at > CALLBACK_DEBOUNCE_SECONDS:
+                tenant.recent_callbacks.pop(old_key, None)
+        
+        previous = tenant.recent_callbacks.get(key)
+        tenant.recent_callbacks[key] = (data, now)
+    
+    return previous is not None and previous[0] == data
+
+def get_user_from_pythonanywhere(tenant, telegram_id):
     """Получение пользователя из PythonAnywhere по Telegram ID"""
     try:
-        response = requests.get(f"{PYTHONANYWHERE_API}/telegram/user/{telegram_id}", timeout=10)
+        response = tenant.request('GET', f"{tenant.api_url}/telegram/user/{telegram_id}")
         if response.status_code == 200:
             return response.json()
         return None
+    except TenantBusyError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения пользователя: {e}")
         return None
 
-def link_account_via_pythonanywhere(email, password, telegram_data):
+def link_account_via_pythonanywhere(tenant, email, password, telegram_data):
     """Связывание аккаунта через PythonAnywhere API"""
     try:
         data = {
@@ -59,47 +353,61 @@ def link_account_via_pythonanywhere(email, password, telegram_data):
             'telegram_data': telegram_data
         }
         
-        response = requests.post(f"{PYTHONANYWHERE_API}/telegram/link", json=data, timeout=10)
+        response = tenant.request('POST', f"{tenant.api_url}/telegram/link", json=data)
         return response.json() if response.status_code == 200 else None
+    except TenantBusyError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка связывания аккаунта: {e}")
         return None
 
-def get_subjects_from_pythonanywhere():
-    """Получение предметов из PythonAnywhere"""
+def get_subjects_from_pythonanywhere(tenant):
+    """Получение предметов из PythonAnywhere (с кэшем на уровне бота)"""
+    cached = tenant.subjects_cache
+    if cached and time.monotonic() - cached[0] < SUBJECTS_CACHE_SECONDS:
+        return cached[1]
+    
     try:
-        response = requests.get(f"{PYTHONANYWHERE_API}/subjects", timeout=10)
+        response = tenant.request('GET', f"{tenant.api_url}/subjects")
         if response.status_code == 200:
-            return response.json().get('subjects', [])
+            subjects = response.json().get('subjects', [])
+            # Пустой ответ может быть временным, его не кэшируем
+            if subjects:
+                tenant.subjects_cache = (time.monotonic(), subjects)
+            return subjects
         return []
+    except TenantBusyError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения предметов: {e}")
         return []
 
-def get_user_stats_from_pythonanywhere(user_id):
+def get_user_stats_from_pythonanywhere(tenant, user_id):
     """Получение статистики пользователя из PythonAnywhere"""
     try:
-        response = requests.get(f"{PYTHONANYWHERE_API}/user/{user_id}/stats", timeout=10)
+        response = tenant.request('GET', f"{tenant.api_url}/user/{user_id}/stats")
         if response.status_code == 200:
             return response.json().get('stats', {})
         return {}
+    except TenantBusyError:
+        raise
     except Exception as e:
         logger.error(f"Ошибка получения статистики: {e}")
         return {}
 
-def get_or_create_telegram_user_supabase(telegram_data):
+def get_or_create_telegram_user_supabase(tenant, telegram_data):
     """Получить или создать Telegram пользователя в Supabase"""
     try:
-        from supabase import create_client
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        supabase = tenant.supabase
         
         telegram_id = telegram_data['id']
         
         # Проверяем существующего пользователя
-        result = supabase.table('telegram_user')\
-            .select('*')\
-            .eq('telegram_id', telegram_id)\
-            .execute()
+        with tenant.slot():
+            result = supabase.table('telegram_user')\
+                .select('*')\
+                .eq('telegram_id', telegram_id)\
+                .execute()
         
         if result.data:
             return result.data[0]
@@ -113,17 +421,40 @@ def get_or_create_telegram_user_supabase(telegram_data):
             'user_id': None
         }
         
-        create_result = supabase.table('telegram_user').insert(new_user).execute()
+        with tenant.slot():
+            create_result = supabase.table('telegram_user').insert(new_user).execute()
         return create_result.data[0] if create_result.data else None
         
+    except TenantBusyError as e:
+        # Запись для аналитики не должна срывать обработку обновления
+        logger.warning(f"Запись в Supabase пропущена: {e}")
+        return None
     except Exception as e:
         logger.error(f"Ошибка работы с Supabase: {e}")
         return None
 
-def handle_start_command(chat_id, user_data):
+def get_start_keyboard(tenant):
+    """Клавиатура стартового меню"""
+    return {
+        'inline_keyboard': [
+            [{'text': '🔗 Связать аккаунт', 'callback_data': 'link_account'}],
+            [{'text': '🌐 Открыть сайт', 'url': tenant.site_url}],
+            [{'text': '❓ Помощь', 'callback_data': 'help'}]
+        ]
+    }
+
+def get_link_keyboard(tenant):
+    """Клавиатура инструкции по связыванию с возвратом в стартовое меню"""
+    return {
+        'inline_keyboard': [
+            [{'text': '⬅️ Назад', 'callback_data': 'help'}]
+        ]
+    }
+
+def handle_start_command(tenant, chat_id, user_data, message_id=None):
     """Обработка команды /start"""
     # Сначала проверяем PythonAnywhere
-    user_info = get_user_from_pythonanywhere(user_data['id'])
+    user_info = get_user_from_pythonanywhere(tenant, user_data['id'])
     
     if user_info and user_info.get('success'):
         # Пользователь уже связан
@@ -138,7 +469,7 @@ def handle_start_command(chat_id, user_data):
 /stats - Ваша статистика
 /help - Помощь
 
-🌐 <a href="https://auniverquizes.pythonanywhere.com">Перейти на сайт</a>
+🌐 <a href="{tenant.site_url}">Перейти на сайт</a>
         """
     else:
         # Пользователь не связан
@@ -153,29 +484,21 @@ def handle_start_command(chat_id, user_data):
 3. Введите ваш пароль
 
 📝 Если у вас нет аккаунта:
-🌐 <a href="https://auniverquizes.pythonanywhere.com/register">Зарегистрируйтесь на сайте</a>
+🌐 <a href="{tenant.site_url}/register">Зарегистрируйтесь на сайте</a>
 
 📚 Команды:
 /link - Связать аккаунт
 /help - Помощь
         """
     
-    keyboard = {
-        'inline_keyboard': [
-            [{'text': '🔗 Связать аккаунт', 'callback_data': 'link_account'}],
-            [{'text': '🌐 Открыть сайт', 'url': 'https://auniverquizes.pythonanywhere.com'}],
-            [{'text': '❓ Помощь', 'callback_data': 'help'}]
-        ]
-    }
-    
-    send_message(chat_id, text, keyboard)
+    send_or_edit_message(tenant, chat_id, text, get_start_keyboard(tenant), message_id)
     
     # Также создаем запись в Supabase для аналитики
-    get_or_create_telegram_user_supabase(user_data)
+    get_or_create_telegram_user_supabase(tenant, user_data)
 
-def handle_link_command(chat_id):
+def handle_link_command(tenant, chat_id, message_id=None):
     """Обработка команды /link"""
-    text = """
+    text = f"""
 🔗 <b>Связывание аккаунта</b>
 
 Для связывания вашего Telegram аккаунта:
@@ -192,25 +515,27 @@ def handle_link_command(chat_id):
 
 ⚠️ <b>Важно:</b> Используйте те же данные, что и для входа на сайт.
 
-🌐 Нет аккаунта? <a href="https://auniverquizes.pythonanywhere.com/register">Зарегистрируйтесь</a>
+🌐 Нет аккаунта? <a href="{tenant.site_url}/register">Зарегистрируйтесь</a>
     """
     
-    send_message(chat_id, text)
+    # При редактировании меню оставляем кнопку возврата, иначе клавиатура пропадет
+    keyboard = get_link_keyboard(tenant) if message_id else None
+    send_or_edit_message(tenant, chat_id, text, keyboard, message_id)
 
-def handle_subjects_command(chat_id, user_data):
+def handle_subjects_command(tenant, chat_id, user_data):
     """Обработка команды /subjects"""
     # Проверяем связанность аккаунта
-    user_info = get_user_from_pythonanywhere(user_data['id'])
+    user_info = get_user_from_pythonanywhere(tenant, user_data['id'])
     
     if not user_info or not user_info.get('success'):
-        send_message(chat_id, "❌ Сначала свяжите аккаунт командой /link")
+        send_message(tenant, chat_id, "❌ Сначала свяжите аккаунт командой /link")
         return
     
     # Получаем предметы из PythonAnywhere
-    subjects = get_subjects_from_pythonanywhere()
+    subjects = get_subjects_from_pythonanywhere(tenant)
     
     if not subjects:
-        send_message(chat_id, "📚 Предметы пока не добавлены.")
+        send_message(tenant, chat_id, "📚 Предметы пока не добавлены.")
         return
     
     text = "📚 <b>Доступные предметы:</b>\n\n"
@@ -226,23 +551,23 @@ def handle_subjects_command(chat_id, user_data):
         question_count = subject['question_count']
         text += f"  📖 {subject['name']} ({question_count} вопросов)\n"
     
-    text += f"\n🌐 <a href='https://auniverquizes.pythonanywhere.com/test_select'>Пройти тест на сайте</a>"
+    text += f"\n🌐 <a href='{tenant.site_url}/test_select'>Пройти тест на сайте</a>"
     
-    send_message(chat_id, text)
+    send_message(tenant, chat_id, text)
 
-def handle_stats_command(chat_id, user_data):
+def handle_stats_command(tenant, chat_id, user_data):
     """Обработка команды /stats"""
     # Проверяем связанность аккаунта
-    user_info = get_user_from_pythonanywhere(user_data['id'])
+    user_info = get_user_from_pythonanywhere(tenant, user_data['id'])
     
     if not user_info or not user_info.get('success'):
-        send_message(chat_id, "❌ Сначала свяжите аккаунт командой /link")
+        send_message(tenant, chat_id, "❌ Сначала свяжите аккаунт командой /link")
         return
     
     user_id = user_info['user']['id']
     
     # Получаем статистику из PythonAnywhere
-    stats = get_user_stats_from_pythonanywhere(user_id)
+    stats = get_user_stats_from_pythonanywhere(tenant, user_id)
     
     if stats and stats.get('total_tests', 0) > 0:
         text = f"""
@@ -253,70 +578,73 @@ def handle_stats_command(chat_id, user_data):
 🏆 Лучший результат: {stats.get('best_percentage', 0)}%
 📚 Предметов изучено: {stats.get('subjects_tested', 0)}
 
-🌐 <a href="https://auniverquizes.pythonanywhere.com/dashboard">Подробная статистика</a>
+🌐 <a href="{tenant.site_url}/dashboard">Подробная статистика</a>
         """
     else:
-        text = """
+        text = f"""
 📊 <b>Статистика пуста</b>
 
 Вы еще не проходили тесты.
 
-🌐 <a href="https://auniverquizes.pythonanywhere.com/test_select">Пройти первый тест</a>
+🌐 <a href="{tenant.site_url}/test_select">Пройти первый тест</a>
         """
     
-    send_message(chat_id, text)
+    send_message(tenant, chat_id, text)
 
-def handle_text_message(chat_id, text, user_data):
+def handle_text_message(tenant, chat_id, text, user_data):
     """Обработка текстовых сообщений"""
     if text.startswith('email:'):
         # Сохраняем email в Supabase для временного хранения
         email = text[6:].strip()
         
         try:
-            from supabase import create_client
-            supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+            supabase = tenant.supabase
             
-            supabase.table('telegram_user')\
-                .update({'link_code': f'email:{email}'})\
-                .eq('telegram_id', user_data['id'])\
-                .execute()
+            with tenant.slot():
+                supabase.table('telegram_user')\
+                    .update({'link_code': f'email:{email}'})\
+                    .eq('telegram_id', user_data['id'])\
+                    .execute()
             
-            send_message(chat_id, f"✅ Email сохранен: {email}\n\nТеперь отправьте пароль в формате:\n<code>password:ваш_пароль</code>")
+            send_message(tenant, chat_id, f"✅ Email сохранен: {email}\n\nТеперь отправьте пароль в формате:\n<code>password:ваш_пароль</code>")
+        except TenantBusyError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка сохранения email: {e}")
-            send_message(chat_id, "❌ Ошибка сохранения email. Попробуйте еще раз.")
+            send_message(tenant, chat_id, "❌ Ошибка сохранения email. Попробуйте еще раз.")
         
     elif text.startswith('password:'):
         # Обрабатываем пароль и связываем аккаунт
         password = text[9:].strip()
         
         try:
-            from supabase import create_client
-            supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+            supabase = tenant.supabase
             
             # Получаем сохраненный email
-            tg_user = supabase.table('telegram_user')\
-                .select('*')\
-                .eq('telegram_id', user_data['id'])\
-                .execute()
+            with tenant.slot():
+                tg_user = supabase.table('telegram_user')\
+                    .select('*')\
+                    .eq('telegram_id', user_data['id'])\
+                    .execute()
             
             if not tg_user.data or not tg_user.data[0].get('link_code', '').startswith('email:'):
-                send_message(chat_id, "❌ Сначала отправьте email в формате:\n<code>email:ваш@email.com</code>")
+                send_message(tenant, chat_id, "❌ Сначала отправьте email в формате:\n<code>email:ваш@email.com</code>")
                 return
             
             email = tg_user.data[0]['link_code'][6:]  # Убираем 'email:'
             
             # Связываем аккаунт через PythonAnywhere API
-            result = link_account_via_pythonanywhere(email, password, user_data)
+            result = link_account_via_pythonanywhere(tenant, email, password, user_data)
             
             if result and result.get('success'):
                 user = result['user']
                 
                 # Очищаем временный код
-                supabase.table('telegram_user')\
-                    .update({'link_code': None})\
-                    .eq('telegram_id', user_data['id'])\
-                    .execute()
+                with tenant.slot():
+                    supabase.table('telegram_user')\
+                        .update({'link_code': None})\
+                        .eq('telegram_id', user_data['id'])\
+                        .execute()
                 
                 text = f"""
 🎉 <b>Аккаунт успешно связан!</b>
@@ -327,20 +655,22 @@ def handle_text_message(chat_id, text, user_data):
 /subjects - Посмотреть предметы
 /stats - Посмотреть статистику
         
-🌐 <a href="https://auniverquizes.pythonanywhere.com/dashboard">Перейти в личный кабинет</a>
+🌐 <a href="{tenant.site_url}/dashboard">Перейти в личный кабинет</a>
                 """
                 
-                send_message(chat_id, text)
+                send_message(tenant, chat_id, text)
             else:
-                send_message(chat_id, "❌ Неверный email или пароль. Попробуйте еще раз.")
+                send_message(tenant, chat_id, "❌ Неверный email или пароль. Попробуйте еще раз.")
                 
+        except TenantBusyError:
+            raise
         except Exception as e:
             logger.error(f"Ошибка связывания аккаунта: {e}")
-            send_message(chat_id, "❌ Ошибка связывания аккаунта. Попробуйте позже.")
+            send_message(tenant, chat_id, "❌ Ошибка связывания аккаунта. Попробуйте позже.")
         
     else:
         # Неизвестная команда
-        send_message(chat_id, """
+        send_message(tenant, chat_id, """
 ❓ Неизвестная команда.
 
 📚 Доступные команды:
@@ -355,6 +685,33 @@ def handle_text_message(chat_id, text, user_data):
 <code>password:ваш_пароль</code>
         """)
 
+# Обработчики нажатий на inline-кнопки: callback_data -> функция(tenant, chat_id, user_data, message_id)
+CALLBACK_HANDLERS = {
+    'link_account': lambda tenant, chat_id, user_data, message_id: handle_link_command(tenant, chat_id, message_id),
+    'help': handle_start_command,
+}
+
+def handle_callback_query(tenant, callback):
+    """Обработка нажатия на inline-кнопку с редактированием исходного сообщения"""
+    # Сначала снимаем индикатор загрузки, затем выполняем остальную работу
+    answer_callback_query(tenant, callback['id'])
+    
+    message = callback.get('message')
+    data = callback.get('data')
+    
+    if not message or data not in CALLBACK_HANDLERS:
+        return
+    
+    callback_handler = CALLBACK_HANDLERS[data]
+    chat_id = message['chat']['id']
+    message_id = message['message_id']
+    
+    if is_duplicate_callback(tenant, chat_id, message_id, data):
+        logger.info(f"Повторное нажатие '{data}' проигнорировано")
+        return
+    
+    callback_handler(tenant, chat_id, callback['from'], message_id)
+
 def handler(request):
     """Основной обработчик webhook"""
     try:
@@ -368,6 +725,23 @@ def handler(request):
                 })
             }
         
+        _update_state.outbound_done = False
+        
+        # Определяем бота по секрету из пути webhook
+        tenant = get_tenant(get_webhook_secret(request))
+        
+        if tenant is None:
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'error': 'Unknown bot'})
+            }
+        
+        if not tenant.verify_header_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+            return {
+                'statusCode': 401,
+                'body': json.dumps({'error': 'Unauthorized'})
+            }
+        
         # Получаем данные от Telegram
         update = request.json
         
@@ -377,7 +751,7 @@ def handler(request):
                 'body': json.dumps({'error': 'No data'})
             }
         
-        logger.info(f"Получено обновление: {update.get('update_id')}")
+        logger.info(f"Получено обновление {update.get('update_id')} для бота {tenant.name}")
         
         # Обрабатываем сообщение
         if 'message' in update:
@@ -388,37 +762,47 @@ def handler(request):
             
             # Обрабатываем команды
             if text == '/start':
-                handle_start_command(chat_id, user_data)
+                handle_start_command(tenant, chat_id, user_data)
             elif text == '/link':
-                handle_link_command(chat_id)
+                handle_link_command(tenant, chat_id)
             elif text == '/subjects':
-                handle_subjects_command(chat_id, user_data)
+                handle_subjects_command(tenant, chat_id, user_data)
             elif text == '/stats':
-                handle_stats_command(chat_id, user_data)
+                handle_stats_command(tenant, chat_id, user_data)
             elif text == '/help':
-                handle_start_command(chat_id, user_data)  # Показываем стартовое сообщение
+                handle_start_command(tenant, chat_id, user_data)  # Показываем стартовое сообщение
             else:
-                handle_text_message(chat_id, text, user_data)
+                handle_text_message(tenant, chat_id, text, user_data)
         
         # Обрабатываем callback запросы
         elif 'callback_query' in update:
             callback = update['callback_query']
-            chat_id = callback['message']['chat']['id']
-            data = callback['data']
-            
-            if data == 'link_account':
-                handle_link_command(chat_id)
-            elif data == 'help':
-                handle_start_command(chat_id, callback['from'])
+            handle_callback_query(tenant, callback)
         
         return {
             'statusCode': 200,
             'body': json.dumps({'ok': True})
         }
         
+    except TenantBusyError as e:
+        logger.warning(str(e))
+        
+        # Часть запросов уже выполнена: повтор доставки продублировал бы их
+        if getattr(_update_state, 'outbound_done', False):
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'ok': True})
+            }
+        
+        # Telegram повторит доставку обновления позже
+        return {
+            'statusCode': 503,
+            'body': json.dumps({'error': 'Bot is busy, retry later'})
+        }
+        
     except Exception as e:
         logger.error(f"Ошибка обработки webhook: {e}")
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': json.dumps({'error': 'Internal error'})
         }
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Тесты маршрутизации ботов и лимитов webhook
+"""
+
+import importlib.util
+import json
+import os
+
+import pytest
+
+WEBHOOK_PATH = os.path.join(os.path.dirname(__file__), '..', 'api', 'telegram', 'webhook.py')
+
+TENANTS = {
+    'path-secret-1': {
+        'name': 'uni1',
+        'token': '111:AAA',
+        'api_url': 'https://uni1.example.com/api',
+        'supabase_url': 'https://uni1.supabase.co',
+        'supabase_key': 'key1',
+        'header_secret': 'header-1'
+    },
+    'path-secret-2': {
+        'token': '222:BBB',
+        'api_url': 'https://uni2.example.com/api',
+        'supabase_url': 'https://uni2.supabase.co',
+        'supabase_key': 'key2'
+    }
+}
+
+class StubResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+class StubSession:
+    """Заглушка requests.Session, запоминающая исходящие запросы"""
+
+    calls = []
+
+    def request(self, method, url, **kwargs):
+        StubSession.calls.append((method, url, kwargs.get('json')))
+        return StubResponse({'ok': True, 'success': False})
+
+class StubRequest:
+    def __init__(self, body, secret=None, headers=None, method='POST'):
+        self.method = method
+        self.args = {'secret': secret} if secret else {}
+        self.headers = headers or {}
+        self.json = body
+
+@pytest.fixture
+def load_webhook(monkeypatch):
+    """Загружает модуль webhook с заданными переменными окружения"""
+    def load(tenants=TENANTS, **env):
+        for name in ('TELEGRAM_TENANTS', 'TELEGRAM_WEBHOOK_SECRET', 'SUPABASE_URL', 'SUPABASE_KEY'):
+            monkeypatch.delenv(name, raising=False)
+        if tenants is not None:
+            monkeypatch.setenv('TELEGRAM_TENANTS', tenants if isinstance(tenants, str) else json.dumps(tenants))
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+
+        spec = importlib.util.spec_from_file_location('webhook', WEBHOOK_PATH)
+        webhook = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(webhook)
+
+        StubSession.calls = []
+        monkeypatch.setattr(webhook.requests, 'Session', StubSession)
+        return webhook
+    return load
+
+def callback_update(data='link_account'):
+    return {
+        'update_id': 1,
+        'callback_query': {
+            'id': 'cq-1',
+            'from': {'id': 5},
+            'data': data,
+            'message': {'message_id': 9, 'chat': {'id': 5}}
+        }
+    }
+
+def test_get_tenant_by_path_secret(load_webhook):
+    webhook = load_webhook()
+
+    assert webhook.get_tenant('path-secret-1').name == 'uni1'
+    assert webhook.get_tenant('path-secret-2').name == 'bot222'
+    assert webhook.get_tenant('unknown') is None
+    assert webhook.get_tenant('') is None
+
+def test_unknown_path_secret_returns_404(load_webhook):
+    webhook = load_webhook()
+
+    response = webhook.handler(StubRequest(callback_update(), secret='unknown'))
+
+    assert response['statusCode'] == 404
+    assert StubSession.calls == []
+
+def test_wrong_header_secret_returns_401(load_webhook):
+    webhook = load_webhook()
+
+    missing = webhook.handler(StubRequest(callback_update(), secret='path-secret-1'))
+    wrong = webhook.handler(StubRequest(
+        callback_update(), secret='path-secret-1',
+        headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}
+    ))
+
+    assert missing['statusCode'] == 401
+    assert wrong['statusCode'] == 401
+    assert StubSession.calls == []
+
+def test_callback_is_routed_to_tenant_bot(load_webhook):
+    webhook = load_webhook()
+
+    response = webhook.handler(StubRequest(
+        callback_update(), secret='path-secret-1',
+        headers={'X-Telegram-Bot-Api-Secret-Token': 'header-1'}
+    ))
+
+    assert response['statusCode'] == 200
+    urls = [url for _, url, _ in StubSession.calls]
+    assert urls == [
+        'https://api.telegram.org/bot111:AAA/answerCallbackQuery',
+        'https://api.telegram.org/bot111:AAA/editMessageText'
+    ]
+
+def test_default_tenant_requires_webhook_secret_header(load_webhook):
+    webhook = load_webhook(tenants=None, TELEGRAM_WEBHOOK_SECRET='single', TELEGRAM_BOT_TOKEN='333:CCC')
+
+    denied = webhook.handler(StubRequest(callback_update()))
+    allowed = webhook.handler(StubRequest(
+        callback_update(), headers={'X-Telegram-Bot-Api-Secret-Token': 'single'}
+    ))
+
+    assert denied['statusCode'] == 401
+    assert allowed['statusCode'] == 200
+
+def test_registry_skips_invalid_tenants(load_webhook):
+    webhook = load_webhook(tenants={
+        'ok': {'token': '1:A', 'api_url': 'https://a/api', 'supabase_url': 'u', 'supabase_key': 'k'},
+        'no-token': {'api_url': 'https://b/api', 'supabase_url': 'u', 'supabase_key': 'k'},
+        'no-supabase': {'token': '2:B', 'api_url': 'https://c/api'},
+        'not-object': 'oops'
+    })
+
+    assert webhook.get_tenant('ok') is not None
+    assert webhook.get_tenant('no-token') is None
+    assert webhook.get_tenant('no-supabase') is None
+    assert webhook.get_tenant('not-object') is None
+
+def test_registry_falls_back_to_global_supabase(load_webhook):
+    webhook = load_webhook(
+        tenants={'s': {'token': '1:A', 'api_url': 'https://a/api'}},
+        SUPABASE_URL='https://global.supabase.co', SUPABASE_KEY='global-key'
+    )
+
+    assert webhook.get_tenant('s').supabase_url == 'https://global.supabase.co'
+
+def test_malformed_registry_returns_404_without_details(load_webhook):
+    webhook = load_webhook(tenants='{not json')
+
+    response = webhook.handler(StubRequest(callback_update(), secret='anything'))
+
+    assert response['statusCode'] == 404
+    assert webhook.get_tenant('anything') is None
+
+def test_telegram_budget_exhaustion_raises_busy(load_webhook):
+    webhook = load_webhook(TELEGRAM_RATE_LIMIT='2', TENANT_ACQUIRE_TIMEOUT='0')
+    tenant = webhook.get_tenant('path-secret-2')
+
+    tenant.take_telegram_budget()
+    tenant.take_telegram_budget()
+    with pytest.raises(webhook.TenantBusyError):
+        tenant.take_telegram_budget()
+
+def test_invalid_limits_fall_back_to_safe_values(load_webhook):
+    webhook = load_webhook(TENANT_MAX_CONCURRENCY='many', TELEGRAM_RATE_LIMIT='0')
+
+    assert webhook.TENANT_MAX_CONCURRENCY == 4
+    assert webhook.TELEGRAM_RATE_LIMIT == 1.0
+
+def test_busy_before_any_request_returns_503(load_webhook):
+    webhook = load_webhook(TELEGRAM_RATE_LIMIT='1', TENANT_ACQUIRE_TIMEOUT='0')
+    tenant = webhook.get_tenant('path-secret-2')
+    tenant.take_telegram_budget()
+
+    response = webhook.handler(StubRequest(callback_update(), secret='path-secret-2'))
+
+    assert response['statusCode'] == 503
+    assert StubSession.calls == []
+
+def test_busy_after_request_returns_200(load_webhook, monkeypatch):
+    webhook = load_webhook()
+
+    def exhausted(tenant, chat_id, message_id, data):
+        raise webhook.TenantBusyError('busy')
+    monkeypatch.setattr(webhook, 'is_duplicate_callback', exhausted)
+
+    response = webhook.handler(StubRequest(callback_update(), secret='path-secret-2'))
+
+    assert response['statusCode'] == 200
+    assert len(StubSession.calls) == 1
+
+def test_repeated_tap_is_debounced(load_webhook):
+    webhook = load_webhook()
+    request = StubRequest(callback_update(), secret='path-secret-2')
+
+    webhook.handler(request)
+    webhook.handler(request)
+
+    methods = [url.rsplit('/', 1)[1] for _, url, _ in StubSession.calls]
+    assert methods == ['answerCallbackQuery', 'editMessageText', 'answerCallbackQuery']
+
+def test_debounce_is_per_button(load_webhook):
+    webhook = load_webhook()
+    tenant = webhook.get_tenant('path-secret-2')
+
+    assert not webhook.is_duplicate_callback(tenant, 5, 9, 'link_account')
+    assert webhook.is_duplicate_callback(tenant, 5, 9, 'link_account')
+    assert not webhook.is_duplicate_callback(tenant, 5, 9, 'help')
+    assert not webhook.is_duplicate_callback(webhook.get_tenant('path-secret-1'), 5, 9, 'help')